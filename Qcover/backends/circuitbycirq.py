@@ -1,10 +1,52 @@
 import os
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+import numpy as np
 import matplotlib.pyplot as plt
-from multiprocessing import Pool, cpu_count
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import networkx as nx
+import sympy
 import cirq
 
+try:
+    import qsimcirq
+except ImportError:
+    qsimcirq = None
+
+from .statevector import compile_tape, cost_diagonal, empty_state, run_tape, set_num_threads, z_diagonal, diagonal_expectation
+
+# the invariants of the circuit of a subgraph, which are computed once and reused by every
+# optimizer iteration, circuit is only built for the cirq method and analytic_terms for p=1
+CompiledSubgraph = namedtuple('CompiledSubgraph', ['qubits', 'qubit_num', 'op_mask', 'weight', 'node_terms', 'edge_terms',
+                                                   'tape', 'coef', 'circuit', 'analytic_terms'])
+
+# upper bound of the memory of a batch of states run together by the native method, each amplitude
+# takes 13 bytes: the float32 real and imaginary parts, the float32 cost and the int8 Z-string diagonal
+BATCH_MEMORY = 2 ** 28
+
+# upper bound of the memory of the cached diagonals, the diagonals of the batches beyond it are
+# rebuilt in every optimizer iteration instead of kept for every element of a large graph
+DIAGONAL_CACHE_MEMORY = 2 ** 30
+
+# the copy of CircuitByCirq owned by a worker process of the parallel executor
+_worker_backend = None
+
+
+def _init_worker(backend):
+    """keep the backend in the worker process, so the weights are only transferred once"""
+    global _worker_backend
+    _worker_backend = backend
+    set_num_threads(1)
+
+
+def _worker_expectations(p, pargs, items):
+    """calculate the expectations of a chunk of subgraphs in the worker process"""
+    _worker_backend._p = p
+    _worker_backend._pargs = pargs
+    return _worker_backend.get_expectations(items)
+
+
 class CircuitByCirq:
     """generate a instance of CircuitByCirq"""
 
@@ -12,6 +54,7 @@ class CircuitByCirq:
                  # p: int = 1,
                  nodes_weight: list = None,
                  edges_weight: list = None,
+                 expectation_calc_method: str = "native",
                  is_parallel: bool = None) -> None:
         """initialize a instance of CircuitByCirq"""
 
@@ -19,120 +62,449 @@ class CircuitByCirq:
         self._nodes_weight = nodes_weight
         self._edges_weight = edges_weight
         self._is_parallel = False if is_parallel is None else is_parallel
+        self._expectation_calc_method = expectation_calc_method
 
         self._element_to_graph = None
         self._pargs = None
         self._expectation_path = []
+        self._prefix_states = {}
+        self._compiled = {}
+        self._batches = {}
+        self._batches_memory = 0
+        self._representatives = {}
+        self._isomorphism_classes = defaultdict(list)
+        self._state_buffers = {}
+        self._cached_weights = (None, None)
+        self._simulator = None
+        self._executor = None
+        self._executor_weights = (None, None)
 
-    def get_operator(self, element, qubit_num):
-        qubits = cirq.LineQubit.range(qubit_num)
-        nodes = [element] if isinstance(element, int) else list(element)
-        op = 1
-        for i in range(qubit_num):
-            if i in nodes:
-                op *= cirq.Z(qubits[i])
-        return op
+    def __getstate__(self):
+        # the simulator and executor hold native handles, so they are recreated in every worker process
+        state = self.__dict__.copy()
+        state['_simulator'] = None
+        state['_executor'] = None
+        return state
+
+    @staticmethod
+    def get_operator(element, qubit_num):
+        """
+        get the Z-string operator on the qubits of element as a bit mask, qubit 0 is the most
+        significant bit like in the states of cirq, the diagonal of the operator is given by z_diagonal
+        """
+        qubits = [element] if isinstance(element, int) else list(element)
+        mask = 0
+        for i in qubits:
+            mask |= 1 << (qubit_num - 1 - i)
+        return mask
 
-    def get_expectation(self, element_graph):
+    def get_prefix_state(self, qubit_num):
         """
-        transform the graph to circuit according to the computing_framework
+        get the state after the Hadamard layer of a qaoa circuit with qubit_num qubits
         Args:
-            graph (nx.Graph): graph to be transformed to circuit
-            params (np.array): Optimal parameters
-            original_e (Optional[None, int, tuple])
+            qubit_num (int): the number of qubits in the circuit
         Return:
-            if original_e=None, then the graph is the whole original graph generated by
-            generate_weighted_graph(), so just return the circuit transformed by it
+            prefix_state (np.array): state vector of H^n|0...0>, which is independent of
+            gamma and beta, so it is simulated once and reused by every optimizer iteration
+        """
+        if qubit_num not in self._prefix_states:
+            ql = cirq.LineQubit.range(qubit_num)
+            prefix = cirq.Circuit(cirq.H.on_each(ql))
+            result = cirq.Simulator(dtype=np.complex64).simulate(prefix, qubit_order=ql, initial_state=0)
+            self._prefix_states[qubit_num] = result.final_state_vector
+        return self._prefix_states[qubit_num]
 
-            if original_e is a int, then the subgraph is generated by node(idx = original_e
-            in whole graph), so return the it's idx mapped by node_to_qubit[], and the circuit
+    def get_simulator(self):
+        """
+        get the state vector simulator, qsimcirq.QSimSimulator is used if qsimcirq is installed,
+        otherwise cirq.Simulator is used, both of them work with single precision (complex64) amplitudes
+        """
+        if self._simulator is None:
+            if qsimcirq is not None:
+                thread_num = 1 if self._is_parallel else os.cpu_count()
+                self._simulator = qsimcirq.QSimSimulator(qsim_options={'t': thread_num, 'f': 4})
+            else:
+                self._simulator = cirq.Simulator(dtype=np.complex64)
+        return self._simulator
 
-            if original_e is a tuple, then the subgraph is generated by edge(node idx = original_e
-            in whole graph), so return the it's idx mapped by node_to_qubit[] as
-            tuple(mapped node_id1, mapped node_id2), and the circuit
+    def get_executor(self):
+        """
+        get the process pool used by expectation_calculation_parallel, the pool is kept across
+        the optimizer iterations and only restarted when the weights of the graph are changed,
+        the workers are spawned since forking a process whose numba or qsim threads were already
+        started can deadlock them, so a script running in parallel must guard its entry point with
+        if __name__ == '__main__': and should call close once the optimization is done. This is a
+        breaking change from the forked workers used before, which did not need the guard on Linux
+        """
+        if self._executor is not None and (self._executor_weights[0] is not self._nodes_weight or
+                                           self._executor_weights[1] is not self._edges_weight):
+            self._executor.shutdown()
+            self._executor = None
+
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=get_context('spawn'),
+                                                 initializer=_init_worker, initargs=(self,))
+            self._executor_weights = (self._nodes_weight, self._edges_weight)
+        return self._executor
+
+    def close(self):
+        """shut down the worker processes of the parallel executor"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def clear_stale_cache(self):
+        """drop the subgraphs compiled from the weights of a previous graph"""
+        if self._cached_weights[0] is not self._nodes_weight or self._cached_weights[1] is not self._edges_weight:
+            self._compiled.clear()
+            self._batches.clear()
+            self._batches_memory = 0
+            self._representatives.clear()
+            self._isomorphism_classes.clear()
+            self._cached_weights = (self._nodes_weight, self._edges_weight)
+
+    def get_representative(self, element_graph):
+        """
+        find the element whose subgraph is isomorphic to the subgraph of element_graph, including
+        the weights and the observed node/edge, so both of them have the same expectation. The
+        candidates are looked up by the Weisfeiler-Lehman hash of the subgraph and then checked
+        with an exact isomorphism test, the classes are kept per p since the subgraphs grow with p
+        Args:
+            element_graph: tuple of (original node/edge, subgraph)
+        Return:
+            the original node/edge representing the isomorphism class of the subgraph
         """
         original_e, graph = element_graph
-        node_to_qubit = defaultdict(int)
-        node_list = list(graph.nodes)
-        for i in range(len(node_list)):
-            node_to_qubit[node_list[i]] = i
+        self.clear_stale_cache()
+        key = (original_e, self._p)
+        if key in self._representatives:
+            return self._representatives[key]
 
-        circ = cirq.Circuit()
-        ql = cirq.LineQubit.range(len(node_list))
-        circ.append(cirq.H(ql[i]) for i in range(len(node_list)))
+        observed = {original_e} if isinstance(original_e, int) else set(original_e)
+        labeled = nx.Graph()
+        for i in graph.nodes:
+            labeled.add_node(i, label='%r|%d' % (self._nodes_weight[i], i in observed))
+        for u, v in graph.edges:
+            if u != v:
+                labeled.add_edge(u, v, weight=repr(self._edges_weight[u, v]))
 
-        gamma_list, beta_list = self._pargs[: self._p], self._pargs[self._p:]
-        for k in range(self._p):
-            for i in graph.nodes:
-                u = node_to_qubit[i]
-                circ.append(cirq.rz(2 * gamma_list * self._nodes_weight[i]).on(ql[u]))
+        graph_hash = nx.weisfeiler_lehman_graph_hash(labeled, edge_attr='weight', node_attr='label')
+        for rep_e, rep_graph in self._isomorphism_classes[graph_hash, self._p]:
+            if nx.is_isomorphic(labeled, rep_graph, node_match=lambda a, b: a['label'] == b['label'],
+                                edge_match=lambda a, b: a['weight'] == b['weight']):
+                break
+        else:
+            rep_e = original_e
+            self._isomorphism_classes[graph_hash, self._p].append((original_e, labeled))
 
-            for edge in graph.edges:
-                u, v = node_to_qubit[edge[0]], node_to_qubit[edge[1]]
-                if u == v:
-                    continue
+        self._representatives[key] = rep_e
+        return rep_e
 
-                circ.append(cirq.CX(ql[u], ql[v]))
-                circ.append(cirq.rz(2 * gamma_list * self._edges_weight[edge[0], edge[1]]).on(ql[v]))
-                circ.append(cirq.CX(ql[u], ql[v]))
+    def get_unique_elements(self):
+        """
+        group the elements of the original graph by the isomorphism class of their subgraphs
+        Return:
+            items (list): one tuple(original node/edge, subgraph) per isomorphism class
+            counts (np.array): the number of elements in each class
+        """
+        counts, items = defaultdict(int), {}
+        for item in self._element_to_graph.items():
+            rep_e = self.get_representative(item)
+            counts[rep_e] += 1
+            items.setdefault(rep_e, item)
+        return list(items.values()), np.fromiter((counts[rep_e] for rep_e in items),
+                                                 dtype=float, count=len(items))
 
-            for nd in graph.nodes:
-                u = node_to_qubit[nd]
-                circ.append(cirq.Moment(cirq.rx(2 * beta_list).on(ql[u])))
+    def get_compiled(self, element_graph):
+        """
+        compile the circuit of a subgraph, the result is cached by (original node/edge, p) since
+        the subgraph of an element is the same in every optimizer iteration
+        Args:
+            element_graph: tuple of (original node/edge, subgraph)
+        Return:
+            compiled (CompiledSubgraph): invariants of the circuit of the subgraph
+        """
+        original_e, graph = element_graph
+        self.clear_stale_cache()
+        key = (original_e, self._p)
+        if key in self._compiled:
+            return self._compiled[key]
+
+        node_list = list(graph.nodes)
+        node_to_qubit = {node: i for i, node in enumerate(node_list)}
+        edge_list = [(u, v) for u, v in graph.edges if u != v]
 
-        qubits = cirq.LineQubit.range(len(node_list))
-        qubit_map = dict(zip(qubits, range(len(node_list))))
+        qubit_num = len(node_list)
+        qubits = cirq.LineQubit.range(qubit_num)
+        node_terms = (np.arange(qubit_num, dtype=np.int32),
+                      np.fromiter((self._nodes_weight[i] for i in node_list), dtype=float, count=qubit_num))
+        edge_terms = (np.array([(node_to_qubit[u], node_to_qubit[v]) for u, v in edge_list],
+                               dtype=np.int32).reshape(-1, 2),
+                      np.fromiter((self._edges_weight[e] for e in edge_list), dtype=float, count=len(edge_list)))
 
         if isinstance(original_e, int):
             weight = self._nodes_weight[original_e]
-            op = cirq.Z(qubits[node_to_qubit[original_e]])
+            mask = self.get_operator(node_to_qubit[original_e], qubit_num)
         else:
             weight = self._edges_weight[original_e]
-            op = cirq.Z(qubits[node_to_qubit[original_e[0]]]) * cirq.Z(qubits[node_to_qubit[original_e[1]]])
+            mask = self.get_operator((node_to_qubit[original_e[0]], node_to_qubit[original_e[1]]), qubit_num)
+
+        tape, coef, circuit, analytic_terms = None, None, None, None
+        if self._p == 1:
+            analytic_terms = self.get_analytic_terms(element_graph)
+        elif self._expectation_calc_method == "native":
+            tape, coef = compile_tape(qubit_num, self._p)
+        else:
+            circuit = self.get_symbolic_circuit(qubits, node_terms, edge_terms)
+
+        self._compiled[key] = CompiledSubgraph(qubits, qubit_num, mask, weight, node_terms, edge_terms,
+                                               tape, coef, circuit, analytic_terms)
+        return self._compiled[key]
+
+    def get_symbolic_circuit(self, ql, node_terms, edge_terms):
+        """
+        build the parameterized qaoa circuit of a subgraph, gamma and beta of the k-th layer are
+        represented by sympy.Symbol('g{k}') and sympy.Symbol('b{k}'), so the circuit only needs to be
+        constructed once and can be reused by every optimizer iteration
+        Args:
+            ql (list): cirq.LineQubit of the subgraph
+            node_terms (tuple): qubits and weights of the nodes
+            edge_terms (tuple): array of (qubit1, qubit2) and weights of the edges
+        Return:
+            circ (cirq.Circuit): the symbolic circuit without the Hadamard layer
+        """
+        circ = cirq.Circuit()
+        for k in range(self._p):
+            gamma, beta = sympy.Symbol('g%d' % k), sympy.Symbol('b%d' % k)
+            for u, weight in zip(*node_terms):
+                circ.append(cirq.rz(2 * gamma * float(weight)).on(ql[u]))
+
+            # exp(-i*gamma*w*Z_u Z_v), the same as CX rz(2*gamma*w) CX as a single diagonal gate
+            for (u, v), weight in zip(*edge_terms):
+                circ.append(cirq.ZZPowGate(exponent=2 * gamma * float(weight) / np.pi,
+                                           global_shift=-0.5).on(ql[u], ql[v]))
+
+            for u in node_terms[0]:
+                circ.append(cirq.Moment(cirq.rx(2 * beta).on(ql[u])))
+        return circ
+
+    def get_analytic_terms(self, element_graph):
+        """
+        collect the weights used by the closed-form expectation of qaoa at p=1
+        Args:
+            element_graph: tuple of (original node/edge, subgraph)
+        Return:
+            (h_u, J_uk of the neighbors) for a node, and for an edge (h_u, h_v, J_uv, J_uk of the
+            neighbors only of u, J_vk of the neighbors only of v, J_uk and J_vk of the common neighbors)
+        """
+        original_e, graph = element_graph
+        if isinstance(original_e, int):
+            u = original_e
+            ju = np.array([self._edges_weight[u, k] for k in graph.adj[u] if k != u], dtype=float)
+            return self._nodes_weight[u], ju
+
+        u, v = original_e
+        nu = {k for k in graph.adj[u] if k not in original_e}
+        nv = {k for k in graph.adj[v] if k not in original_e}
+        common = list(nu & nv)
+        ju = np.array([self._edges_weight[u, k] for k in nu - nv], dtype=float)
+        jv = np.array([self._edges_weight[v, k] for k in nv - nu], dtype=float)
+        ju_common = np.array([self._edges_weight[u, k] for k in common], dtype=float)
+        jv_common = np.array([self._edges_weight[v, k] for k in common], dtype=float)
+        return self._nodes_weight[u], self._nodes_weight[v], self._edges_weight[original_e], \
+            ju, jv, ju_common, jv_common
+
+    def get_batch(self, items, compiled):
+        """
+        build the cost diagonals, Z-string diagonals and weights of a batch of subgraphs, the
+        batches are the same in every optimizer iteration, so the arrays are cached as long as
+        the cache stays below DIAGONAL_CACHE_MEMORY
+        Args:
+            items (list): list of tuple(original node/edge, subgraph)
+            compiled (list): the CompiledSubgraph of every item
+        Return:
+            costs (np.array), diags (np.array) of shape (batch, 2**n) and weights (np.array),
+            the cost diagonals are only built for the native method
+        """
+        key = (tuple(original_e for original_e, _ in items), self._p)
+        if key in self._batches:
+            return self._batches[key]
 
-        state = cirq.final_state_vector(circ)
-        exp_res = op.expectation_from_state_vector(state, qubit_map=qubit_map)
+        costs = None
+        if self._expectation_calc_method == "native":
+            costs = np.stack([cost_diagonal(c.qubit_num, c.node_terms, c.edge_terms) for c in compiled])
+        diags = np.stack([z_diagonal(c.qubit_num, c.op_mask) for c in compiled])
+        weights = np.array([c.weight for c in compiled], dtype=float)
 
-        return weight * exp_res.real
+        memory = diags.nbytes + (0 if costs is None else costs.nbytes)
+        if self._batches_memory + memory <= DIAGONAL_CACHE_MEMORY:
+            self._batches[key] = (costs, diags, weights)
+            self._batches_memory += memory
+        return costs, diags, weights
+
+    def get_expectations_native(self, items):
+        """
+        calculate the expectations of a batch of subgraphs by running their gate tapes, the
+        subgraphs with the same qubit number share the gate tape and differ only in their cost
+        diagonals, so they are run together in batches of states bounded by BATCH_MEMORY, the
+        state buffers are allocated once per qubit number and reused by all the batches
+        Args:
+            items (list): list of tuple(original node/edge, subgraph)
+
+        Returns:
+            np.array of the expectations in the order of items
+        """
+        groups = defaultdict(list)
+        compiled = [self.get_compiled(item) for item in items]
+        for i, c in enumerate(compiled):
+            groups[c.qubit_num].append(i)
+
+        exp_res = np.empty(len(items))
+        for qubit_num, idx in groups.items():
+            batch_size = max(1, BATCH_MEMORY // (13 * 2 ** qubit_num))
+            for start in range(0, len(idx), batch_size):
+                batch = idx[start: start + batch_size]
+                costs, diags, weights = self.get_batch([items[i] for i in batch], [compiled[i] for i in batch])
+                if qubit_num not in self._state_buffers or len(self._state_buffers[qubit_num]) < len(batch):
+                    self._state_buffers[qubit_num] = empty_state(qubit_num, len(batch))
+                states = self._state_buffers[qubit_num][:len(batch)]
+
+                run_tape(states, qubit_num, compiled[batch[0]].tape, compiled[batch[0]].coef, self._pargs, costs)
+                exp_res[batch] = diagonal_expectation(states, diags) * weights
+        return exp_res
+
+    def get_param_resolver(self):
+        """build the cirq.ParamResolver which maps the symbols g{k}, b{k} to the current pargs"""
+        params = {}
+        for k in range(self._p):
+            params['g%d' % k] = self._pargs[k]
+            params['b%d' % k] = self._pargs[self._p + k]
+        return cirq.ParamResolver(params)
+
+    def get_expectation_analytic(self, element_graph):
+        """
+        calculate the expectation of the subgraph with the closed-form expression of qaoa at p=1,
+        with h the weights of nodes, J the weights of edges and N(u) the neighbors of node u:
+            <Z_u> = sin(2b) * sin(2g*h_u) * prod_{k in N(u)} cos(2g*J_uk)
+            <Z_u Z_v> = sin(4b)/2 * sin(2g*J_uv) * (cos(2g*h_u) * prod_{k in N(u)-v} cos(2g*J_uk)
+                                                    + cos(2g*h_v) * prod_{k in N(v)-u} cos(2g*J_vk))
+                        + sin(2b)^2/2 * (cos(2g*(h_u-h_v)) * Q(-) - cos(2g*(h_u+h_v)) * Q(+))
+        where Q(+-) = prod_{k only in N(u)} cos(2g*J_uk) * prod_{k only in N(v)} cos(2g*J_vk)
+                      * prod_{k in both N(u) and N(v)} cos(2g*(J_uk +- J_vk))
+        Args:
+            element_graph: tuple of (original node/edge, subgraph)
+
+        Returns:
+            expectation of the subgraph
+        """
+        terms = self.get_compiled(element_graph).analytic_terms
+        gamma, beta = self._pargs[0], self._pargs[1]
+        if len(terms) == 2:
+            hu, ju = terms
+            exp_res = np.sin(2 * beta) * np.sin(2 * gamma * hu) * np.prod(np.cos(2 * gamma * ju))
+            return hu * exp_res
+
+        hu, hv, juv, ju, jv, ju_common, jv_common = terms
+        cos_u, cos_v = np.prod(np.cos(2 * gamma * ju)), np.prod(np.cos(2 * gamma * jv))
+        pu = cos_u * np.prod(np.cos(2 * gamma * ju_common))
+        pv = cos_v * np.prod(np.cos(2 * gamma * jv_common))
+        q_minus = cos_u * cos_v * np.prod(np.cos(2 * gamma * (ju_common - jv_common)))
+        q_plus = cos_u * cos_v * np.prod(np.cos(2 * gamma * (ju_common + jv_common)))
+
+        exp_res = 0.5 * np.sin(4 * beta) * np.sin(2 * gamma * juv) * \
+            (np.cos(2 * gamma * hu) * pu + np.cos(2 * gamma * hv) * pv) + \
+            0.5 * np.sin(2 * beta) ** 2 * \
+            (np.cos(2 * gamma * (hu - hv)) * q_minus - np.cos(2 * gamma * (hu + hv)) * q_plus)
+        return juv * exp_res
+
+    def get_expectation(self, element_graph, prefix_state=None, resolver=None):
+        """
+        calculate the expectation of the subgraph
+        Args:
+            element_graph: tuple of (original node/edge, subgraph)
+            prefix_state (np.array): the state after the Hadamard layer, looked up if None
+            resolver (cirq.ParamResolver): resolver of the current pargs, built if None
+
+        Returns:
+            expectation of the subgraph
+        """
+        if self._p == 1:
+            return self.get_expectation_analytic(element_graph)
+        if self._expectation_calc_method == "native":
+            return self.get_expectations_native([element_graph])[0]
+
+        compiled = self.get_compiled(element_graph)
+        if prefix_state is None:
+            prefix_state = self.get_prefix_state(compiled.qubit_num)
+        if resolver is None:
+            resolver = self.get_param_resolver()
+
+        result = self.get_simulator().simulate(compiled.circuit, param_resolver=resolver,
+                                               qubit_order=compiled.qubits, initial_state=prefix_state)
+        state = result.final_state_vector.astype(np.complex64, copy=False)
+        _, diags, _ = self.get_batch([element_graph], [compiled])
+        exp_res = diagonal_expectation(state, diags[0])
+
+        return compiled.weight * float(exp_res)
+
+    def get_expectations(self, items):
+        """
+        calculate the expectations of a batch of subgraphs, the subgraphs are grouped by
+        their qubit number, so the prefix state is looked up once per group and the
+        parameter resolver once per batch
+        Args:
+            items (list): list of tuple(original node/edge, subgraph)
+
+        Returns:
+            np.array of the expectations in the order of items
+        """
+        if self._p == 1:
+            return np.fromiter((self.get_expectation_analytic(item) for item in items),
+                               dtype=float, count=len(items))
+        if self._expectation_calc_method == "native":
+            return self.get_expectations_native(items)
+
+        groups = defaultdict(list)
+        for i, (_, graph) in enumerate(items):
+            groups[len(graph)].append(i)
+
+        resolver = self.get_param_resolver()
+        exp_res = np.empty(len(items))
+        for qubit_num in sorted(groups):
+            prefix_state = self.get_prefix_state(qubit_num)
+            for i in groups[qubit_num]:
+                exp_res[i] = self.get_expectation(items[i], prefix_state, resolver)
+        return exp_res
 
     def expectation_calculation(self):
-        if self._is_parallel:
+        # the closed-form expectations at p=1 are cheaper than the worker processes
+        if self._is_parallel and self._p > 1:
             return self.expectation_calculation_parallel()
         else:
             return self.expectation_calculation_serial()
 
     def expectation_calculation_serial(self):
-        cpu_num = cpu_count()
-        os.environ['OMP_NUM_THREADS'] = str(cpu_num)
-        os.environ['OPENBLAS_NUM_THREADS'] = str(cpu_num)
-        os.environ['MKL_NUM_THREADS'] = str(cpu_num)
-        os.environ['VECLIB_MAXIMUM_THREADS'] = str(cpu_num)
-        os.environ['NUMEXPR_NUM_THREADS'] = str(cpu_num)
-
-        res = 0
-        for item in self._element_to_graph.items():
-            res += self.get_expectation(item)
+        items, counts = self.get_unique_elements()
+        res = float(counts @ self.get_expectations(items))
 
         print("Total expectation of original graph is: ", res)
         self._expectation_path.append(res)
         return res
 
     def expectation_calculation_parallel(self):
-        cpu_num = 1
-        os.environ['OMP_NUM_THREADS'] = str(cpu_num)
-        os.environ['OPENBLAS_NUM_THREADS'] = str(cpu_num)
-        os.environ['MKL_NUM_THREADS'] = str(cpu_num)
-        os.environ['VECLIB_MAXIMUM_THREADS'] = str(cpu_num)
-        os.environ['NUMEXPR_NUM_THREADS'] = str(cpu_num)
-
-        circ_res = []
-        pool = Pool(os.cpu_count())  # , maxtasksperchild=1
-        circ_res.append(pool.map(self.get_expectation, list(self._element_to_graph.items()), chunksize=1))
-
-        pool.terminate()  # pool.close()
-        pool.join()
+        items, counts = self.get_unique_elements()
+        chunk_size = max(1, len(items) // (4 * os.cpu_count()))
+        chunks = [items[i: i + chunk_size] for i in range(0, len(items), chunk_size)]
+        try:
+            circ_res = list(self.get_executor().map(_worker_expectations, [self._p] * len(chunks),
+                                                    [self._pargs] * len(chunks), chunks))
+        except BrokenProcessPool as err:
+            self.close()
+            raise RuntimeError("the worker processes exited unexpectedly. The workers are spawned and import "
+                               "the main module again, so a script running with is_parallel=True must guard "
+                               "its entry point with if __name__ == '__main__':") from err
 
-        res = sum(circ_res[0])
+        res = float(counts @ np.concatenate(circ_res))
         print("Total expectation of original graph is: ", res)
         self._expectation_path.append(res)
         return res
@@ -0,0 +1,196 @@
+"""
+State vector kernels used by CircuitByCirq to simulate the qaoa circuits of subgraphs with NumPy
+
+The states of a batch of circuits with n qubits are stored as an array of shape (batch, 2**n),
+qubit 0 is the most significant bit of the index like in cirq, so the states agree with the
+ones returned by cirq.Simulator. The rx gates are applied by reshaping the states so that the
+axis of the target qubit is exposed.
+
+The rz gates of the nodes and the CX rz CX gates of the edges of a qaoa layer are diagonal and
+commute, so they are fused into exp(-i*gamma*C) with the cost diagonal
+C = sum_u h_u Z_u + sum_uv J_uv Z_u Z_v, which is computed once per subgraph.
+A qaoa circuit is then compiled into a gate tape, an int32 array whose rows are
+(gate, qubit, parameter index), with the angle of a gate given by
+coefficient * pargs[parameter index]. The tape only depends on the qubit number and p, so
+circuits with the same qubit number are run together as a batch of states with their own
+cost diagonals. If numba is installed, the tape is executed by jit-compiled kernels which
+also loop over the batch, so a batch costs a single call from Python, otherwise by the
+NumPy kernels which apply every gate to the whole batch at once. The state of a single circuit is kept as a float32 array
+of shape (2, 2**n) whose rows are the real and imaginary parts, so the kernels load
+contiguous lanes of real and imaginary values instead of interleaved complex64.
+"""
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+PHASE, RX = 0, 1
+
+
+def _qubit_view(states, qubit_num, qubit):
+    """view the states as (batch, higher qubits, qubit, lower qubits)"""
+    return states.reshape(states.shape[0], 2 ** qubit, 2, 2 ** (qubit_num - qubit - 1))
+
+
+def apply_phase(states, costs, theta):
+    """apply exp(-i*theta*C) in place, with costs the diagonal C of every circuit of the batch"""
+    states *= np.exp(-1j * theta * costs).astype(states.dtype)
+
+
+def apply_rx(states, qubit_num, qubit, theta):
+    """apply rx(theta) = [[cos(theta/2), -i*sin(theta/2)], [-i*sin(theta/2), cos(theta/2)]] on qubit in place"""
+    view = _qubit_view(states, qubit_num, qubit)
+    cos, sin = np.cos(theta / 2), -1j * np.sin(theta / 2)
+    matrix = np.array([[cos, sin], [sin, cos]], dtype=states.dtype)
+    view[...] = np.einsum('ij,bhjl->bhil', matrix, view)
+
+
+def cost_diagonal(qubit_num, node_terms, edge_terms):
+    """
+    return the diagonal of C = sum_u h_u Z_u + sum_uv J_uv Z_u Z_v of a subgraph
+    Args:
+        qubit_num (int): qubit number of the circuit
+        node_terms (tuple): int array of the qubits and float array of the weights of the nodes
+        edge_terms (tuple): int array of shape (edge number, 2) of the qubits and float array of the weights of the edges
+    """
+    (node_qubits, node_weights), (edge_qubits, edge_weights) = node_terms, edge_terms
+    idx = np.arange(2 ** qubit_num)
+    z = 1 - 2 * ((idx >> (qubit_num - 1 - np.arange(qubit_num))[:, np.newaxis]) & 1).astype(np.int8)
+    cost = node_weights @ z[node_qubits]
+    for (u, v), weight in zip(edge_qubits, edge_weights):
+        cost += weight * (z[u] * z[v])
+    return cost.astype(np.float32)
+
+
+def compile_tape(qubit_num, p):
+    """
+    compile the qaoa circuit of a subgraph into a gate tape, each layer is the phase of the cost
+    diagonal followed by the rx gates
+    Args:
+        qubit_num (int): qubit number of the circuit
+        p (int): layer number of the circuit
+
+    Returns:
+        tape (np.array): int32 array of shape (gate number, 3)
+        coef (np.array): the angle of a gate is coef * pargs[parameter index]
+    """
+    layer = np.zeros((qubit_num + 1, 3), dtype=np.int32)
+    layer[0, 0] = PHASE
+    layer[1:, 0], layer[1:, 1], layer[1:, 2] = RX, np.arange(qubit_num), p
+    layer_coef = np.full(qubit_num + 1, 2.)
+    layer_coef[0] = 1
+
+    # the parameter index is shifted by the layer number
+    tape = np.tile(layer, (p, 1))
+    tape[:, 2] += np.repeat(np.arange(p, dtype=np.int32), len(layer))
+    return tape, np.tile(layer_coef, p)
+
+
+def empty_state(qubit_num, batch=1):
+    """allocate the real and imaginary parts of the states of a batch of circuits with qubit_num qubits"""
+    return np.empty((batch, 2, 2 ** qubit_num), dtype=np.float32)
+
+
+def _run_tape_numpy(states, qubit_num, tape, coef, params, costs):
+    batch = np.full((states.shape[0], 2 ** qubit_num), 2 ** (-qubit_num / 2), dtype=np.complex64)
+    for g, (gate, u, k) in enumerate(tape):
+        if gate == PHASE:
+            apply_phase(batch, costs, coef[g] * params[k])
+        else:
+            apply_rx(batch, qubit_num, u, coef[g] * params[k])
+    states[:, 0], states[:, 1] = batch.real, batch.imag
+
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True)
+    def _nb_apply_phase(re, im, cost, theta):
+        for i in numba.prange(re.shape[0]):
+            angle = np.float32(theta) * cost[i]
+            cos, sin = np.cos(angle), np.sin(angle)
+            r, m = re[i], im[i]
+            re[i] = cos * r + sin * m
+            im[i] = cos * m - sin * r
+
+    @numba.njit(parallel=True, fastmath=True)
+    def _nb_apply_rx(re, im, bit, theta):
+        cos, sin = np.float32(np.cos(theta / 2)), np.float32(np.sin(theta / 2))
+        low = (1 << bit) - 1
+        for j in numba.prange(re.shape[0] // 2):
+            # the pairs of a block of 2**bit consecutive j are contiguous in both halves
+            i0 = ((j & ~low) << 1) | (j & low)
+            i1 = i0 | (1 << bit)
+            r0, m0, r1, m1 = re[i0], im[i0], re[i1], im[i1]
+            re[i0] = cos * r0 + sin * m1
+            im[i0] = cos * m0 - sin * r1
+            re[i1] = cos * r1 + sin * m0
+            im[i1] = cos * m1 - sin * r0
+
+    @numba.njit
+    def _nb_run_tape(re, im, qubit_num, tape, coef, params, cost):
+        re[:] = 2 ** (-qubit_num / 2)
+        im[:] = 0
+        for g in range(tape.shape[0]):
+            gate, u, k = tape[g, 0], tape[g, 1], tape[g, 2]
+            if gate == PHASE:
+                _nb_apply_phase(re, im, cost, coef[g] * params[k])
+            else:
+                _nb_apply_rx(re, im, qubit_num - 1 - u, coef[g] * params[k])
+
+    @numba.njit
+    def _nb_run_tapes(states, qubit_num, tape, coef, params, costs):
+        for b in range(states.shape[0]):
+            _nb_run_tape(states[b, 0], states[b, 1], qubit_num, tape, coef, params, costs[b])
+
+
+def set_num_threads(thread_num):
+    """set the number of threads used by the jit-compiled kernels"""
+    if numba is not None:
+        numba.set_num_threads(thread_num)
+
+
+def run_tape(states, qubit_num, tape, coef, params, costs):
+    """
+    simulate a batch of compiled qaoa circuits with the same qubit number from H^n|0...0>
+    Args:
+        states (np.array): buffer returned by empty_state which receives the final states
+        qubit_num (int): qubit number of the circuits
+        tape (np.array): gate tape returned by compile_tape
+        coef (np.array): angle coefficients returned by compile_tape
+        params (np.array): pargs of the qaoa circuit, gamma of each layer followed by beta of each layer
+        costs (np.array): cost diagonals returned by cost_diagonal, of shape (batch, 2**qubit_num)
+    """
+    if numba is not None:
+        _nb_run_tapes(states, qubit_num, tape, coef, np.asarray(params, dtype=float), costs)
+    else:
+        _run_tape_numpy(states, qubit_num, tape, coef, params, costs)
+
+
+def z_diagonal(qubit_num, mask):
+    """
+    return the diagonal of the Z-string operator on the qubits whose bits are set in mask,
+    the entry of index i is (-1)^popcount(i & mask)
+    """
+    idx = np.arange(2 ** qubit_num, dtype=np.uint32) & mask
+    parity = np.zeros(2 ** qubit_num, dtype=np.uint32)
+    for bit in range(qubit_num):
+        if mask >> bit & 1:
+            parity ^= idx >> bit
+    return 1 - 2 * (parity & 1).astype(np.int8)
+
+
+def probabilities(states):
+    """return |amplitude|^2 of complex states, or of a batch of states returned by run_tape"""
+    if np.iscomplexobj(states):
+        return states.real ** 2 + states.imag ** 2
+    return states[:, 0] ** 2 + states[:, 1] ** 2
+
+
+def diagonal_expectation(states, diags):
+    """
+    return the expectation of a diagonal operator on every state, for a Z-string operator this is
+    sum_i (-1)^popcount(i & mask) * |amplitude_i|^2 with the diagonal given by z_diagonal
+    """
+    return (probabilities(states) * diags).sum(axis=-1)
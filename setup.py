@@ -56,6 +56,12 @@ setup(
         'test': [
             'pytest>=4.4.0',
         ],
+        'qsim': [
+            'qsimcirq',
+        ],
+        'numba': [
+            'numba',
+        ],
         'docs': [
             'Sphinx',
             'sphinxcontrib-napoleon',
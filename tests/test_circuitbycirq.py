@@ -0,0 +1,126 @@
+import os
+import sys
+import numpy as np
+import networkx as nx
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Qcover'))
+try:
+    import cirq
+    from core import Qcover
+    from optimizers import COBYLA
+    from backends import statevector
+    from backends.circuitbycirq import CircuitByCirq
+except ImportError as err:
+    # core imports every backend, so the simulators of all of them are needed
+    pytest.skip('Qcover can not be imported: %s' % err, allow_module_level=True)
+
+
+def weighted_graph(scale=1.):
+    """a small graph with node weights, a triangle, a path and an isolated node"""
+    g = nx.Graph()
+    for i, w in enumerate([1.5, -0.7, 0.3, 2.1, -1.2, 0.8]):
+        g.add_node(i, weight=scale * w)
+    for u, v, w in [(0, 1, 0.9), (1, 2, -1.3), (0, 2, 0.4), (2, 3, 1.1), (3, 4, -0.6)]:
+        g.add_edge(u, v, weight=scale * w)
+    return g
+
+
+def uniform_path_graph(node_num=6):
+    g = nx.path_graph(node_num)
+    nx.set_node_attributes(g, 1, 'weight')
+    nx.set_edge_attributes(g, 1, 'weight')
+    return g
+
+
+def reference_expectation(g, p, pargs):
+    """simulate the qaoa circuit of the whole graph with cirq in double precision"""
+    nodes = list(g.nodes)
+    ql = cirq.LineQubit.range(len(nodes))
+    qubit = dict(zip(nodes, ql))
+    circ = cirq.Circuit(cirq.H.on_each(ql))
+    for k in range(p):
+        for i in nodes:
+            circ.append(cirq.rz(2 * pargs[k] * g.nodes[i]['weight']).on(qubit[i]))
+        for u, v in g.edges:
+            circ.append([cirq.CX(qubit[u], qubit[v]), cirq.rz(2 * pargs[k] * g[u][v]['weight']).on(qubit[v]),
+                         cirq.CX(qubit[u], qubit[v])])
+        circ.append(cirq.rx(2 * pargs[p + k]).on_each(ql))
+    state = cirq.final_state_vector(circ, qubit_order=ql, dtype=np.complex128)
+
+    qubit_map = dict(zip(ql, range(len(ql))))
+    op = sum(g.nodes[i]['weight'] * cirq.Z(qubit[i]) for i in nodes) + \
+        sum(g[u][v]['weight'] * cirq.Z(qubit[u]) * cirq.Z(qubit[v]) for u, v in g.edges)
+    return op.expectation_from_state_vector(state, qubit_map).real
+
+
+def calculate(backend, g, p, pargs, weights=None):
+    """calculate the expectation with the backend like Qcover.run does, optionally with given weights"""
+    qc = Qcover(g, p, optimizer=COBYLA(), backend=backend)
+    backend._nodes_weight, backend._edges_weight = qc.get_graph_weights() if weights is None else weights
+    return qc.calculate(np.asarray(pargs, dtype=float))
+
+
+PARGS = {1: [0.37, -0.81], 2: [0.37, -0.52, -0.81, 0.24]}
+
+
+@pytest.mark.parametrize('p', [1, 2])
+@pytest.mark.parametrize('method', ['native', 'cirq'])
+def test_expectation(method, p):
+    g = weighted_graph()
+    res = calculate(CircuitByCirq(expectation_calc_method=method), g, p, PARGS[p])
+    # p=1 uses the closed-form expression, the simulations work with complex64 amplitudes
+    assert res == pytest.approx(reference_expectation(g, p, PARGS[p]), abs=1e-12 if p == 1 else 1e-4)
+
+
+@pytest.mark.parametrize('p', [1, 2])
+def test_expectation_without_numba(monkeypatch, p):
+    monkeypatch.setattr(statevector, 'numba', None)
+    g = weighted_graph()
+    res = calculate(CircuitByCirq(expectation_calc_method='native'), g, p, PARGS[p])
+    assert res == pytest.approx(reference_expectation(g, p, PARGS[p]), abs=1e-4)
+
+
+def test_isomorphic_subgraphs():
+    g = uniform_path_graph()
+    backend = CircuitByCirq()
+    weights = Qcover(g, 1, optimizer=COBYLA(), backend=backend).get_graph_weights()
+    # the classes of isomorphic subgraphs at p=1 must not be reused at p=2
+    for p in [1, 2]:
+        res = calculate(backend, g, p, PARGS[p], weights)
+        assert res == pytest.approx(reference_expectation(g, p, PARGS[p]), abs=1e-4)
+
+    elements, counts = backend.get_unique_elements()
+    assert len(elements) < len(backend._element_to_graph) and counts.sum() == len(backend._element_to_graph)
+
+
+def test_new_weights_clear_caches():
+    backend = CircuitByCirq()
+    calculate(backend, weighted_graph(), 2, PARGS[2])
+    # new weight dicts must not reuse the subgraphs compiled from the previous ones
+    g = weighted_graph(scale=-0.6)
+    res = calculate(backend, g, 2, PARGS[2])
+    assert res == pytest.approx(reference_expectation(g, 2, PARGS[2]), abs=1e-4)
+
+
+def test_parallel_expectation():
+    backend = CircuitByCirq(is_parallel=True)
+    try:
+        g = weighted_graph()
+        weights = Qcover(g, 2, optimizer=COBYLA(), backend=backend).get_graph_weights()
+        res = calculate(backend, g, 2, PARGS[2], weights)
+        assert res == pytest.approx(reference_expectation(g, 2, PARGS[2]), abs=1e-4)
+
+        # the workers are kept across iterations with the same weights
+        executor = backend._executor
+        calculate(backend, g, 2, PARGS[2], weights)
+        assert backend._executor is executor
+
+        # and restarted with new weights, since they hold a copy of the backend
+        g = weighted_graph(scale=-0.6)
+        res = calculate(backend, g, 2, PARGS[2])
+        assert backend._executor is not executor
+        assert res == pytest.approx(reference_expectation(g, 2, PARGS[2]), abs=1e-4)
+    finally:
+        backend.close()
+    assert backend._executor is None